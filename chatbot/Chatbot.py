@@ -1,12 +1,69 @@
-import concurrent.futures
+import asyncio
+import hashlib
+import re
 import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from threading import Lock
 from ddgs import DDGS
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+from cachetools import LRUCache
+import diskcache
+import xxhash
 import google.generativeai as genai
 import os
 from dotenv import load_dotenv
+from article_parser import parse_article
+
+# Search results we never try to extract
+_BAD_URL_RE = re.compile(r"\.pdf|facebook|youtube|instagram|shopee|tiki")
+
+# Fixed opening of every RAG prompt
+_PROMPT_HEADER = (
+    "Dưới đây là các tài liệu tham khảo được thu thập từ các trang web uy tín.\n"
+    "Hãy đọc kỹ và chỉ sử dụng thông tin từ các tài liệu này để trả lời câu hỏi."
+)
+
+# Sentence boundaries for context trimming (Vietnamese uses Latin punctuation)
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+def _cache_key(query):
+    """Canonical cache key so case, punctuation and spacing variants match"""
+    normalized = unicodedata.normalize("NFKC", query).casefold()
+    normalized = re.sub(r"[^\w\s]", " ", normalized)
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+
+def _simhash(text):
+    """64-bit SimHash of a text over its words and word bigrams"""
+    # Sentences are short: with longer shingles one edited word changes
+    # most of a sentence's features and its fingerprint with them
+    words = re.findall(r"\w+", text.casefold())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    weights = [0] * 64
+    for feature in features:
+        h = xxhash.xxh64_intdigest(feature.encode())
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _drop_near_duplicates(text, seen):
+    """Drop sentences within 10 bits of a fingerprint in seen, recording new ones"""
+    kept = []
+    for sentence in _SENTENCE_SPLIT_RE.split(text):
+        if not sentence.strip():
+            continue
+        fingerprint = _simhash(sentence)
+        if any(bin(fingerprint ^ other).count("1") <= 10 for other in seen):
+            continue
+        seen.append(fingerprint)
+        kept.append(sentence)
+    return " ".join(kept)
 
 
 class HueChatbot:
@@ -35,229 +92,413 @@ class HueChatbot:
             Trả lời ngắn gọn, súc tích và tập trung vào văn hóa, lịch sử, ẩm thực và các điểm du lịch nổi tiếng của Huế.""",
         )
 
+        # Generation configuration, built once and reused for every answer
+        self.generation_config = genai.GenerationConfig(
+            temperature=0.1,
+            max_output_tokens=800,
+            top_p=0.95,
+            top_k=40,
+        )
+
         # Configuration from environment
         self.max_search_results = int(os.getenv("MAX_SEARCH_RESULTS", 2))
         self.max_history = int(os.getenv("MAX_HISTORY", 5))
         self.request_timeout = int(os.getenv("REQUEST_TIMEOUT", 5))
+        self.max_page_bytes = int(os.getenv("MAX_PAGE_BYTES", 256 * 1024))
+        self.max_context_chars = int(os.getenv("MAX_CONTEXT_CHARS", 1000))
+        self.embedding_model = os.getenv(
+            "EMBEDDING_MODEL",
+            "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2",
+        )
+
+        # Sentence embedder for context trimming, loaded on first use
+        self._embedder = None
 
         # Chat history management
         self.history = []
+        # "Q: ... A: ..." context of the last max_history turns, kept up to
+        # date per turn, with the length of each turn's segment
+        self._history_str = ""
+        self._history_spans = deque()
+
+        # Disk-backed search and page caches so restarts start warm,
+        # bounded in size and evicting the least recently used entries
+        cache_dir = os.path.expanduser(os.getenv("CACHE_DIR", "~/.hue_cache"))
+        self.cache_ttl = int(os.getenv("CACHE_TTL", 86400))
+        self.search_cache = diskcache.Cache(
+            os.path.join(cache_dir, "search"),
+            size_limit=64 << 20,
+            eviction_policy="least-recently-used",
+        )
+        self.page_cache = diskcache.Cache(
+            os.path.join(cache_dir, "pages"),
+            size_limit=64 << 20,
+            eviction_policy="least-recently-used",
+        )
 
-        # Search cache for performance
-        self.search_cache = {}
+        # Answers for identical question + context pairs
+        self.answer_cache = LRUCache(maxsize=128)
         self.cache_lock = Lock()
 
-        # Requests session for better performance
-        self.session = requests.Session()
-        self.session.headers.update(
-            {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
-        )
+        # Search client kept open across questions so its connections stay warm
+        self._ddgs = DDGS()
+
+        # Worker processes for HTML parsing, which is CPU-bound and would
+        # otherwise serialise on the GIL
+        self.parse_pool = self._start_parse_pool()
+
+        # Headers for the shared aiohttp session
+        self.headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+        }
+
+        # One event loop for the chatbot's lifetime, so the aiohttp session
+        # (created on first use) keeps its connections and DNS cache across
+        # questions
+        self._runner = asyncio.Runner()
+        self._http = None
+
+    def _start_parse_pool(self):
+        """Create the parser process pool with its workers already starting"""
+        workers = int(os.getenv("PARSE_WORKERS", min(4, os.cpu_count() or 1)))
+        pool = ProcessPoolExecutor(max_workers=workers)
+        # Start the workers now, in the background, so process start-up and
+        # imports don't eat into the first question's extraction budget
+        for _ in range(workers):
+            pool.submit(parse_article, b"<p></p>")
+        return pool
 
     def _search_duckduckgo(self, query, max_results=None):
-        """Search DuckDuckGo with caching for better performance"""
+        """Search DuckDuckGo with caching, yielding URLs as they are accepted"""
         if max_results is None:
             max_results = self.max_search_results
 
-        with self.cache_lock:
-            if query in self.search_cache:
-                print("🚀 Dùng cache")
-                return self.search_cache[query]
+        # The URL count is part of the result, so it is part of the key too
+        key = (_cache_key(query), max_results)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            print("🚀 Dùng cache")
+            yield from cached
+            return
 
+        search_start = time.time()
+        urls = []
         try:
-            with DDGS() as ddgs:
-                search_query = f"{query} Huế, Việt Nam"
-                results = list(
-                    ddgs.text(search_query, max_results=max_results * 2, region="vn-vi")
-                )
-                urls = []
-                for r in results:
-                    url = r["href"]
-                    if not any(
-                        bad in url.lower()
-                        for bad in [
-                            ".pdf",
-                            "facebook",
-                            "youtube",
-                            "instagram",
-                            "shopee",
-                            "tiki",
-                        ]
-                    ):
-                        urls.append(url)
-                    if len(urls) >= max_results:
-                        break
-
-                with self.cache_lock:
-                    self.search_cache[query] = urls
-                return urls
+            search_query = f"{query} Huế, Việt Nam"
+            results = self._ddgs.text(
+                search_query, max_results=max_results * 2, region="vn-vi"
+            )
+            for r in results:
+                url = r["href"]
+                if not _BAD_URL_RE.search(url.lower()):
+                    urls.append(url)
+                    yield url
+                if len(urls) >= max_results:
+                    break
         except Exception as e:
             print(f"⚠️ Lỗi tìm kiếm: {e}")
-            return []
+            return
+        print(f"   ⚡ Search: {time.time() - search_start:.1f}s")
+
+        if urls:
+            self.search_cache.set(key, urls, expire=self.cache_ttl)
+
+    def _session(self):
+        """The shared aiohttp session, created on the runner's loop on first use"""
+        if self._http is None:
+            connector = aiohttp.TCPConnector(limit=32, ttl_dns_cache=300)
+            self._http = aiohttp.ClientSession(
+                connector=connector, headers=self.headers
+            )
+        return self._http
+
+    async def _extract_article_fast(self, session, url, timeout=3):
+        """Extract article content using aiohttp + lxml - FAST"""
+        cached = self.page_cache.get(url)
+        if cached is not None:
+            return cached
 
-    def _extract_article_fast(self, url, timeout=3):
-        """Extract article content using requests + BeautifulSoup - FAST"""
         try:
-            response = self.session.get(url, timeout=timeout)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.content, "html.parser")
-            for script in soup(["script", "style", "nav", "header", "footer", "aside"]):
-                script.decompose()
-            content_selectors = [
-                "article",
-                ".article-content",
-                ".content",
-                ".post-content",
-                ".entry-content",
-                ".main-content",
-                "main",
-                ".article-body",
-            ]
-            text = ""
-            for selector in content_selectors:
-                content = soup.select_one(selector)
-                if content:
-                    text = content.get_text(strip=True, separator=" ")
-                    break
-            if not text or len(text) < 100:
-                text = soup.get_text(strip=True, separator=" ")
-            if len(text) > 2000:
-                text = text[:2000] + "..."
+            client_timeout = aiohttp.ClientTimeout(
+                sock_connect=timeout, sock_read=timeout
+            )
+            # Stream the body and stop once enough HTML has arrived, the text
+            # is capped at 2000 characters anyway
+            async with session.get(url, timeout=client_timeout) as response:
+                response.raise_for_status()
+                # Only set when the server declared a charset, otherwise the
+                # page's own <meta charset> is used
+                encoding = response.charset
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(16384):
+                    body += chunk
+                    if len(body) >= self.max_page_bytes:
+                        break
+            # Parse in the process pool so other downloads keep flowing
+            loop = asyncio.get_running_loop()
+            pool = self.parse_pool
+            try:
+                text = await loop.run_in_executor(
+                    pool, parse_article, bytes(body), encoding
+                )
+            except BrokenProcessPool:
+                # A worker died; replace the pool once for later pages and
+                # parse this one on a thread instead
+                if self.parse_pool is pool:
+                    print("⚠️ Khởi động lại tiến trình phân tích HTML")
+                    self.parse_pool = self._start_parse_pool()
+                    pool.shutdown(wait=False)
+                text = await loop.run_in_executor(
+                    None, parse_article, bytes(body), encoding
+                )
+            if text:
+                self.page_cache.set(url, text, expire=self.cache_ttl)
             return text
         except Exception as e:
             # print(f"⚠️ Lỗi {url[:30]}...: {str(e)[:20]}...")
             return ""
 
-    def _process_urls_parallel(self, urls):
-        """Process multiple URLs in parallel for better performance"""
-        combined_text = ""
-        successful_count = 0
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_url = {
-                executor.submit(self._extract_article_fast, url, 3): url for url in urls
-            }
+    async def _process_urls_parallel(self, urls):
+        """Extract URLs concurrently as soon as the search yields them"""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        def feed():
+            # Drive the (blocking) search iterator off the event loop
             try:
-                for future in concurrent.futures.as_completed(future_to_url, timeout=8):
-                    try:
-                        content = future.result(timeout=1)
-                        if content and len(content.strip()) > 50:
-                            combined_text += content + "\n\n"
-                            successful_count += 1
-                            print(
-                                f"✅ Trích xuất thành công {successful_count}/{len(urls)}"
+                for url in urls:
+                    loop.call_soon_threadsafe(queue.put_nowait, url)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        parts = []
+        total = 0
+        # Fingerprints of sentences already collected, so boilerplate shared
+        # by several sites only enters the prompt once
+        seen = deque(maxlen=512)
+        url_count = 0
+        successful_count = 0
+        session = self._session()
+        loop.run_in_executor(None, feed)
+        getter = asyncio.ensure_future(queue.get())
+        pending = {getter}
+        # The 8s extraction budget starts with the first URL
+        deadline = None
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0, deadline - loop.time())
+                done, pending = await asyncio.wait(
+                    pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    print(f"⏰ Timeout - xử lý được {successful_count}/{url_count}")
+                    break
+                for future in done:
+                    if future is getter:
+                        url = future.result()
+                        if url is None:
+                            continue
+                        if deadline is None:
+                            deadline = loop.time() + 8
+                        url_count += 1
+                        pending.add(
+                            asyncio.ensure_future(
+                                self._extract_article_fast(session, url, 3)
                             )
-                            if len(combined_text) > 5000:
-                                break
-                    except Exception:
+                        )
+                        getter = asyncio.ensure_future(queue.get())
+                        pending.add(getter)
                         continue
-            except concurrent.futures.TimeoutError:
-                print(f"⏰ Timeout - xử lý được {successful_count}/{len(urls)}")
-                for future in future_to_url:
-                    future.cancel()
-        return combined_text
-
-    def _generate_answer(self, question, context, history=""):
-        """Generate answer using Gemini AI with context and history"""
-        clean_context = context.replace("\n", " ").strip()
-        clean_history = history.replace("\n", " ").strip() if history else ""
-
-        prompt = f"""
-            Dưới đây là các tài liệu tham khảo được thu thập từ các trang web uy tín.
-            Hãy đọc kỹ và chỉ sử dụng thông tin từ các tài liệu này để trả lời câu hỏi.
-
-            {f"Lịch sử hội thoại trước đó: {clean_history}" if clean_history else ""}
+                    content = _drop_near_duplicates(future.result(), seen)
+                    if content and len(content.strip()) > 50:
+                        parts.append(content)
+                        total += len(content)
+                        successful_count += 1
+                        # More URLs may still arrive, so no "/total" here
+                        print(f"✅ Trích xuất thành công {successful_count}")
+                if total > 5000:
+                    break
+        finally:
+            # Stop downloads we no longer need and let them unwind, so
+            # their connections go back to the pool before we return
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        return "\n\n".join(parts), url_count
+
+    def _trim_context(self, question, context):
+        """Keep only the sentences most similar to the question"""
+        if len(context) <= self.max_context_chars:
+            return context
+
+        if self._embedder is None:
+            try:
+                # Optional dependency, imported here so that startup and parser
+                # workers never pay for torch
+                from sentence_transformers import SentenceTransformer
+
+                self._embedder = SentenceTransformer(self.embedding_model, device="cpu")
+            except ImportError:
+                # Not installed, the context is sent untrimmed
+                self._embedder = False
+            except Exception as e:
+                # Broken torch installs raise OSError/RuntimeError on import
+                print(f"⚠️ Không tải được mô hình embedding: {e}")
+                self._embedder = False
+        if not self._embedder:
+            return context
 
-            ---
-            TÀI LIỆU THAM KHẢO:
-            {clean_context}
-            ---
+        sentences = [s for s in _SENTENCE_SPLIT_RE.split(context) if s.strip()]
+        try:
+            embeddings = self._embedder.encode(
+                [question] + sentences, normalize_embeddings=True
+            )
+        except Exception as e:
+            print(f"⚠️ Lỗi embedding: {e}")
+            return context
+        scores = embeddings[1:] @ embeddings[0]
+
+        # Take the best sentences until the budget is spent, in page order
+        keep = []
+        total = 0
+        for i in scores.argsort()[::-1]:
+            if keep and total + len(sentences[i]) > self.max_context_chars:
+                break
+            keep.append(i)
+            total += len(sentences[i])
+        return " ".join(sentences[i] for i in sorted(keep))
 
-            CÂU HỎI: {question}
+    def _generate_answer(self, question, context, history=""):
+        """Stream answer chunks from Gemini AI using context and history"""
+        clean_history = history.replace("\n", " ").strip()
+
+        # The history is part of the prompt, so a follow-up question only
+        # reuses an answer given under the same conversation
+        answer_key = (
+            _cache_key(question),
+            hashlib.blake2b(context.encode(), digest_size=16).digest(),
+            hashlib.blake2b(clean_history.encode(), digest_size=16).digest(),
+        )
+        with self.cache_lock:
+            cached = self.answer_cache.get(answer_key)
+        if cached is not None:
+            print("🚀 Dùng cache")
+            yield cached
+            return
 
-            TRẢ LỜI:"""
+        context = self._trim_context(question, context)
+        clean_context = context.replace("\n", " ").strip()
 
-        try:
-            # Set up generation configuration
-            generation_config = genai.GenerationConfig(
-                temperature=0.1,
-                max_output_tokens=800,
-                top_p=0.95,
-                top_k=40,
-            )
+        # Join the sections once; the history section is only added when
+        # there is history, and no template indentation reaches the model
+        sections = [_PROMPT_HEADER]
+        if clean_history:
+            sections.append(f"Lịch sử hội thoại trước đó: {clean_history}")
+        sections.append(f"---\nTÀI LIỆU THAM KHẢO:\n{clean_context}\n---")
+        sections.append(f"CÂU HỎI: {question}")
+        sections.append("TRẢ LỜI:")
+        prompt = "\n\n".join(sections)
+
+        # Stream content from the model so the first words show up early;
+        # errors propagate to chat(), which keeps them out of the history
+        response = self.model.generate_content(
+            contents=prompt,
+            generation_config=self.generation_config,
+            stream=True,
+        )
+        chunks = []
+        for chunk in response:
+            chunks.append(chunk.text)
+            yield chunk.text
 
-            # Set safety settings
-            safety_settings = {
-                "HARM_CATEGORY_HARASSMENT": "BLOCK_MEDIUM_AND_ABOVE",
-                "HARM_CATEGORY_HATE_SPEECH": "BLOCK_MEDIUM_AND_ABOVE",
-                "HARM_CATEGORY_SEXUALLY_EXPLICIT": "BLOCK_MEDIUM_AND_ABOVE",
-                "HARM_CATEGORY_DANGEROUS_CONTENT": "BLOCK_MEDIUM_AND_ABOVE",
-            }
-
-            # Generate content using the model
-            response = self.model.generate_content(
-                contents=prompt,
-                generation_config=generation_config,
-                # safety_settings=safety_settings,
-            )
-            return response.text.strip()
-        except Exception as e:
-            return f"Lỗi khi gọi AI Gemini: {e}"
+        with self.cache_lock:
+            self.answer_cache[answer_key] = "".join(chunks)
 
     def _rag_process(self, question, history=""):
-        """Complete RAG process: search, extract, generate - TURBO MODE"""
+        """Complete RAG process: search, extract, generate - TURBO MODE, streamed"""
         start_time = time.time()
 
         print("🔍 Tìm kiếm...")
-        search_start = time.time()
-        urls = self._search_duckduckgo(question)
-        print(f"   ⚡ Search: {time.time() - search_start:.1f}s")
-
-        if not urls:
-            return "Không tìm thấy thông tin."
-
-        print(f"📄 Xử lý {len(urls)} trang...")
         extract_start = time.time()
-        combined_text = self._process_urls_parallel(urls)
-        print(f"   ⚡ Extract: {time.time() - extract_start:.1f}s")
+        combined_text, url_count = self._runner.run(
+            self._process_urls_parallel(self._search_duckduckgo(question))
+        )
+        print(f"   ⚡ Search + Extract: {time.time() - extract_start:.1f}s")
+
+        if not url_count:
+            yield "Không tìm thấy thông tin."
+            return
 
         if not combined_text.strip():
-            return "Không trích xuất được thông tin."
+            yield "Không trích xuất được thông tin."
+            return
 
         print(f"📝 Thu thập {len(combined_text)} ký tự")
         print("🤖 Tạo câu trả lời...")
         ai_start = time.time()
-        answer = self._generate_answer(question, combined_text, history)
-        print(f"   ⚡ AI: {time.time() - ai_start:.1f}s")
+        yield from self._generate_answer(question, combined_text, history)
+        print(f"\n   ⚡ AI: {time.time() - ai_start:.1f}s")
 
         total_time = time.time() - start_time
         print(f"🚀 TỔNG: {total_time:.1f}s")
 
-        return answer
-
     def chat(self, question):
         """Single chat interaction with history context"""
         print("\n" + "=" * 50)
         print(f"👤 Bạn: {question}")
         print("=" * 50)
 
-        # Create context from history
-        history_context = ""
-        if self.history:
-            recent_history = self.history[-self.max_history :]
-            history_context = " ".join(
-                [f"Q: {h['q']} A: {h['a']}" for h in recent_history]
-            )
-
-        # Get answer
-        answer = self._rag_process(question, history_context)
+        # Print the answer as it streams in
+        chunks = []
+        try:
+            for chunk in self._rag_process(question, self._history_str):
+                if not chunks:
+                    print("\n🎭 Hướng dẫn viên Huế: ", end="")
+                print(chunk, end="", flush=True)
+                chunks.append(chunk)
+        except Exception as e:
+            # Search, extraction or the Gemini stream failed; report it on
+            # its own line and keep the partial answer out of the history,
+            # so it never reaches later prompts
+            error = f"❌ Lỗi: {e}"
+            print(f"\n{error}" if chunks else f"\n🎭 Hướng dẫn viên Huế: {error}")
+            return error
+        print()
+        answer = "".join(chunks).strip()
 
         # Save to history
-        self.history.append({"q": question, "a": answer})
+        self._remember(question, answer)
 
-        print(f"\n🎭 Hướng dẫn viên Huế: {answer}")
         return answer
 
+    def _remember(self, question, answer):
+        """Record a turn and roll it into the history context"""
+        self.history.append({"q": question, "a": answer})
+
+        segment = f"Q: {question} A: {answer}"
+        if self._history_spans:
+            segment = " " + segment
+        self._history_str += segment
+        self._history_spans.append(len(segment))
+
+        # Cut the oldest turns off the front, including the separator that
+        # now leads the new first segment
+        while len(self._history_spans) > self.max_history:
+            cut = self._history_spans.popleft()
+            if self._history_spans:
+                cut += 1
+                self._history_spans[0] -= 1
+            self._history_str = self._history_str[cut:]
+
+    def close(self):
+        """Release the HTTP session, event loop, parser processes and caches"""
+        if self._http is not None:
+            self._runner.run(self._http.close())
+        self._runner.close()
+        self.parse_pool.shutdown()
+        self.search_cache.close()
+        self.page_cache.close()
+
     def start(self):
         """Start interactive chatbot session"""
         print("🏛️ Chào mừng đến với Chatbot Văn hóa Huế!")
@@ -290,4 +531,7 @@ if __name__ == "__main__":
     chatbot = HueChatbot()
 
     # Start interactive session
-    chatbot.start()
+    try:
+        chatbot.start()
+    finally:
+        chatbot.close()
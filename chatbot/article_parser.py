@@ -0,0 +1,67 @@
+"""Lightweight HTML article extraction, safe to import in parser worker processes"""
+import re
+
+import lxml.html
+from lxml import etree
+
+# Elements whose class attribute contains the given class token
+_CLASS_XPATH = "//*[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]"
+
+# Main-content containers, in priority order (first match wins)
+_CONTENT_XPATHS = tuple(
+    etree.XPath(path)
+    for path in (
+        "//article",
+        _CLASS_XPATH.format("article-content"),
+        _CLASS_XPATH.format("content"),
+        _CLASS_XPATH.format("post-content"),
+        _CLASS_XPATH.format("entry-content"),
+        _CLASS_XPATH.format("main-content"),
+        "//main",
+        _CLASS_XPATH.format("article-body"),
+    )
+)
+
+# Page chrome that never belongs to the article text
+_NOISE_XPATH = etree.XPath("//script|//style|//nav|//header|//footer|//aside")
+
+# <meta charset="..."> / http-equiv charset declarations in raw HTML
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.I)
+
+
+def _detect_encoding(html, declared=None):
+    """Page encoding from the header or <meta>, defaulting to UTF-8"""
+    if not declared:
+        match = _META_CHARSET_RE.search(html, 0, 65536)
+        declared = match.group(1).decode("ascii") if match else "utf-8"
+    return declared
+
+
+def _element_text(element):
+    """Whitespace-normalised text of an element, one space between text nodes"""
+    return " ".join(" ".join(element.itertext()).split())
+
+
+def parse_article(html, encoding=None):
+    """Extract the main article text from raw HTML bytes"""
+    # Resolve the encoding up front so the parser never falls back to
+    # statistical charset detection
+    try:
+        parser = lxml.html.HTMLParser(encoding=_detect_encoding(html, encoding))
+    except LookupError:
+        # Declared charset unknown to libxml2
+        parser = lxml.html.HTMLParser(encoding="utf-8")
+    tree = lxml.html.document_fromstring(html, parser=parser)
+    for element in _NOISE_XPATH(tree):
+        element.drop_tree()
+    text = ""
+    for xpath in _CONTENT_XPATHS:
+        nodes = xpath(tree)
+        if nodes:
+            text = _element_text(nodes[0])
+            break
+    if len(text) < 100:
+        text = _element_text(tree)
+    if len(text) > 2000:
+        text = text[:2000] + "..."
+    return text